@@ -4,110 +4,115 @@
           use `ref(label_object)` to refer to label
    instructions: for example, instruction `mov`, use it like `mov(B, r1, r2)`, `B` is the modifier,
                  where you could use B(byte, 8 bit), S(short, 16bit), D(dword, 32 bit), Q(qword, bit)
+                 jumps and calls to a label could also use AUTO, e.g. `jmp(AUTO, ref(label))`, the
+                 assembler then picks the smallest displacement that fits
+   assembler: the helpers above build into a module wide default program, use
+              `with Assembler() as a:` and `a.mov(...)`, `a.tag(...)`, `a.assemble()` for another one
 """
 
-import struct
-import ctypes
+import hashlib
+import itertools
+import marshal
+import os
+import tempfile
+
+_SIZE_MODIFIER = {
+    64: 64,
+    32: 48,
+    16: 32,
+    8: 16,
+}
 
 def size2modifier(size):
-    global inses
-    if size == 64:
-        mod = 64
-    elif size == 32:
-        mod = 48
-    elif size == 16:
-        mod = 32
-    elif size == 8:
-        mod = 16
-    else:
-        raise Exception('invalid size {} for instruction mov at #{}'.format(size, len(inses)))
-    return mod
-
-def pack64(s):
-    return struct.pack('<Q', s)
-
-def pack32(s):
-    return struct.pack('<I', s)
-
-def pack16(s):
-    return struct.pack('<H', s)
-
-def pack8(s):
-    return struct.pack('<B', s)
-
-def signed2unsigned(x, size):
-    if size == 8:
-        return ctypes.c_uint8(x).value
-    elif size == 16:
-        return ctypes.c_uint16(x).value
-    elif size == 32:
-        return ctypes.c_uint32(x).value
-    elif size == 64:
-        return ctypes.c_uint64(x).value
+    try:
+        return _SIZE_MODIFIER[size]
+    except KeyError:
+        raise Exception('invalid size {}'.format(size))
+
+def fit_size(dis):
+    for size in (8, 16, 32):
+        if -(1 << (size - 1)) <= dis < (1 << (size - 1)):
+            return size
+    return 64
+
+_MASK = {
+    8: 0xff,
+    16: 0xffff,
+    32: 0xffffffff,
+    64: 0xffffffffffffffff,
+}
+
+# little endian encoders, values are masked to the operand width
+def _mk_pack(size):
+    mask = _MASK[size]
+    n = size // 8
+    return lambda v: (v & mask).to_bytes(n, 'little')
+
+_PACK = {size: _mk_pack(size) for size in _MASK}
 
 def pack(val, size):
-    if size == 64:
-        return pack64(val)
-    elif size == 32:
-        return pack32(val)
-    elif size == 16:
-        return pack16(val)
-    elif size == 8:
-        return pack8(val)
+    return _PACK[size](val)
+
+# a register operand is always its number in one byte, whatever the size
+_REG_BYTES = tuple(bytes([r]) for r in range(0x11 + 1))
 
 class Reg:
+    __slots__ = ('name', 'num')
+
     def __init__(self, name):
         r = int(name[1:])
         assert r <= 0x11, 'reg is only 0 - {}'.format(0x11)
         self.name = name
         self.num = r
 
-    def make(self, size):
-        return pack8(self.num)
-
     def __str__(self):
         return self.name
 
 class Mem:
+    __slots__ = ('addr',)
+
     def __init__(self, addr):
         self.addr = addr
 
-    def make(self, size):
-        if type(self.addr) is Imm:
-            return self.addr.make(size)
-        elif type(self.addr) is Reg:
-            return self.addr.make(size)
-    
     def __str__(self):
         return 'Mem({})'.format(self.addr)
 
 class StackMem:
+    __slots__ = ('addr',)
+
     def __init__(self, addr):
         self.addr = addr
-    
-    def make(self):
-        return self.addr.make(size) 
 
     def __str__(self):
         return 'StackMem({})'.format(self.addr)
 
 class Imm:
-    def __init__(self, val):
-        self.val = val
-
-    def make(self, size):
-        return pack(self.val, size)
+    __slots__ = ('val',)
+
+    # small ints recur all over a program, they share one object each,
+    # val is only ever set here so a shared object never changes
+    _cache = {}
+
+    def __new__(cls, val):
+        if type(val) is int and -256 <= val < 4096:
+            imm = cls._cache.get(val)
+            if imm is None:
+                imm = cls._cache[val] = super().__new__(cls)
+                imm.val = val
+            return imm
+        imm = super().__new__(cls)
+        imm.val = val
+        return imm
 
     def __str__(self):
         return 'Imm({})'.format(hex(self.val))
 
 class LabelRef:
-    def __init__(self, name):
-        self.name = name
+    __slots__ = ('label', 'name')
 
-    def make(self, size):
-        # temp value
-        return pack(0, size)
+    def __init__(self, label):
+        self.label = label
+        self.name = label.name
 
     def __str__(self):
         return 'L:{}'.format(self.name)
@@ -122,71 +127,112 @@ class Label:
     def tag(self, def_site):
         self.def_site = def_site
 
-    def make(self, code):
-        return b''
-
-    def ref(self, ins_idx):
-        self.use_sites.append(ins_idx)
-        return LabelRef(self.name)
-
-    def resolve(self):
-        global inses
-        byte_offset = 0
-        for i in range(self.def_site):
-            byte_offset += len(inses[i].bytecode)
-        self.resolved = byte_offset
-
-    def rewrite(self):
-        global inses
-        for use in self.use_sites:
-            offset = 0
-            for i in range(use + 1):
-                offset += len(inses[i].bytecode)
-            ins = inses[use]
-            dis = self.resolved - offset
-            ins.dest = Imm(signed2unsigned(self.resolved - offset, ins.size))
-            ins.make(ins.CODE)
+    def ref(self):
+        return LabelRef(self)
+
+    def use(self, ins, ins_idx):
+        self.use_sites.append((ins, ins_idx))
+
+    def resolve(self, offsets):
+        self.resolved = offsets[self.def_site]
+
+    def shrink(self, offsets):
+        changed = False
+        for ins, use in self.use_sites:
+            if not ins.auto:
+                continue
+            size = fit_size(self.resolved - offsets[use + 1])
+            # only ever shrink, so the iteration is monotone
+            if size < ins.size:
+                ins.size = size
+                ins.make(ins.CODE)
+                changed = True
+        return changed
+
+    def rewrite(self, offsets, out):
+        for ins, use in self.use_sites:
+            # the displacement is the tail of the jumping instruction and
+            # relative to its end
+            end = offsets[use + 1]
+            out[end - ins.size // 8:end] = pack(self.resolved - end, ins.size)
 
 class Exit:
     CODE = 0
+    __slots__ = ('bytecode',)
+    auto = False
+
     def __init__(self):
-        self.bytecode = bytes([self.CODE])
+        self.bytecode = _EXIT_BC
 
     def make(self, code):
-        return self.bytecode
+        self.bytecode = _EXIT_BC
+        return _EXIT_BC
 
     def __str__(self):
         return "exit"
 
+_EXIT_BC = bytes([Exit.CODE])
+
+def operand_kind(op):
+    if type(op) is Mem or type(op) is StackMem:
+        return type(op), type(op.addr)
+    return type(op), None
+
+# (dest kind, src kind) -> mode, without the size modifier
+_BINOP_MODE_TABLE = {
+    (Reg, None, Reg, None): 0,
+    (Reg, None, Mem, Imm): 1,
+    (Reg, None, Mem, Reg): 0xc,
+    (Mem, Imm, Reg, None): 2,
+    (Mem, Reg, Reg, None): 0xb,
+    (Reg, None, StackMem, Imm): 3,
+    (Reg, None, StackMem, Reg): 0xe,
+    (StackMem, Imm, Reg, None): 4,
+    (StackMem, Reg, Reg, None): 0xd,
+    (Reg, None, Imm, None): 5,
+}
+
 def binop_mode(dest, src, size):
-    if type(dest) is Reg and type(src) is Reg:
-        mode = 0
-    elif type(dest) is Reg and type(src) is Mem:
-        if type(src.addr) is Imm:
-            mode = 1
-        elif type(src.addr) is Reg:
-            mode = 0xc
-    elif type(dest) is Mem and type(src) is Reg:
-        if type(dest.addr) is Reg:
-            mode = 0xb
-        elif type(dest) is Imm:
-            mode = 2
-    elif type(dest) is Reg and type(src) is StackMem:
-        if type(src.addr) is Imm:
-            mode = 3
-        elif type(src.addr) is Reg:
-            mode = 0xe
-    elif type(dest) is StackMem and type(src) is Reg:
-        if type(dest.addr) is Imm:
-            mode = 4
-        elif type(dest.addr) is Reg:
-            mode = 0xd
-    elif type(dest) is Reg and type(src) is Imm:
-        mode = 5
+    key = operand_kind(dest) + operand_kind(src)
+    try:
+        mode = _BINOP_MODE_TABLE[key]
+    except KeyError:
+        raise Exception('invalid operands {}, {}'.format(dest, src))
     return mode | size2modifier(size)
 
+def operand_value(op):
+    if type(op) is Reg:
+        return op.num
+    elif type(op) is Imm:
+        return op.val
+    elif type(op) is Mem or type(op) is StackMem:
+        return operand_value(op.addr)
+    # label placeholder
+    return 0
+
+def operand_expr(kind, arg, size):
+    # registers take a byte, immediates and label displacements the full size
+    if Imm in kind or LabelRef in kind:
+        return '({} & {}).to_bytes({}, "little")'.format(arg, _MASK[size], size // 8)
+    return '_REG_BYTES[{}]'.format(arg)
+
+# (code, operand kinds..., size) -> specialized encoder of raw operand values
+_ENCODERS = {}
+
+def make_encoder(code, mode, kinds, size):
+    args = ['x{}'.format(i) for i in range(len(kinds))]
+    parts = [repr(bytes((code, mode)))]
+    parts += [operand_expr(kind, arg, size) for kind, arg in zip(kinds, args)]
+    src = 'def encode({}):\n    return {}\n'.format(', '.join(args), ' + '.join(parts))
+    namespace = {'_REG_BYTES': _REG_BYTES}
+    exec(src, namespace)
+    return namespace['encode']
+
 
 class BinOp:
+    __slots__ = ('dest', 'src', 'size', 'bytecode')
+    auto = False
+
     def __init__(self, dest, src, size):
         self.dest = dest
         self.src = src
@@ -194,11 +240,14 @@ class BinOp:
         self.bytecode = None
 
     def make(self, code):
-        mode = binop_mode(self.dest, self.src, self.size)
-        self.bytecode = bytes([code])
-        self.bytecode += bytes([mode])
-        self.bytecode += self.dest.make(self.size)
-        self.bytecode += self.src.make(self.size)
+        dest_kind = operand_kind(self.dest)
+        src_kind = operand_kind(self.src)
+        key = (code, dest_kind, src_kind, self.size)
+        encode = _ENCODERS.get(key)
+        if encode is None:
+            mode = binop_mode(self.dest, self.src, self.size)
+            encode = _ENCODERS[key] = make_encoder(code, mode, (dest_kind, src_kind), self.size)
+        self.bytecode = encode(operand_value(self.dest), operand_value(self.src))
         return self.bytecode
 
     def __str__(self):
@@ -206,63 +255,85 @@ class BinOp:
 
 class Mov(BinOp):
     CODE = 1
+    __slots__ = ()
 
 class Add(BinOp):
     CODE = 2
+    __slots__ = ()
     
 class Sub(BinOp):
     CODE = 3
+    __slots__ = ()
 
 class Mul(BinOp):
     CODE = 4
+    __slots__ = ()
 
 class Div(BinOp):
     CODE = 5
+    __slots__ = ()
 
 class Mod(BinOp):
     CODE = 6
+    __slots__ = ()
 
 class Xor(BinOp):
     CODE = 7
+    __slots__ = ()
 
 class Or(BinOp):
     CODE = 8
+    __slots__ = ()
 
 class And(BinOp):
     CODE = 9
+    __slots__ = ()
 
 class Shl(BinOp):
     CODE = 10
+    __slots__ = ()
 
 class Shr(BinOp):
     CODE = 11
+    __slots__ = ()
 
-def unop_mode(dest, size):
-    if type(dest) is Reg:
-        mode = 6
-    elif type(dest) is Imm:
-        mode = 7
-    elif type(dest) is Mem:
-        mode = 8
-    elif type(dest) is LabelRef:
-        # NOTE: relative jump only
-        mode = 7
+_UNOP_MODE_TABLE = {
+    Reg: 6,
+    Imm: 7,
+    Mem: 8,
+    # NOTE: relative jump only
+    LabelRef: 7,
+}
 
+def unop_mode(dest, size):
+    try:
+        mode = _UNOP_MODE_TABLE[type(dest)]
+    except KeyError:
+        raise Exception('invalid operand {}'.format(dest))
     return mode | size2modifier(size)
-    
+
 class UnOp:
+    __slots__ = ('dest', 'size', 'auto', 'bytecode', 'resolved')
+
     def __init__(self, dest, size):
         self.dest = dest
+        self.auto = size == AUTO
+        if self.auto:
+            assert type(dest) is LabelRef, 'AUTO size is only for label reference'
+            # start pessimistic, shrunk while assembling
+            size = Q
         self.size = size
         self.bytecode = None
         self.resolved = None
 
     def make(self, code):
-        mode = unop_mode(self.dest, self.size)
-        
-        self.bytecode = bytes([code])
-        self.bytecode += bytes([mode])
-        self.bytecode += self.dest.make(self.size)
+        dest_kind = operand_kind(self.dest)
+        key = (code, dest_kind, self.size)
+        encode = _ENCODERS.get(key)
+        if encode is None:
+            mode = unop_mode(self.dest, self.size)
+            encode = _ENCODERS[key] = make_encoder(code, mode, (dest_kind,), self.size)
+        self.bytecode = encode(operand_value(self.dest))
         return self.bytecode
 
     def __str__(self):
@@ -270,67 +341,93 @@ class UnOp:
 
 class Not(UnOp):
     CODE = 12
+    __slots__ = ()
 
 class Pop(UnOp):
     CODE = 13
+    __slots__ = ()
 
 class Push(UnOp):
     CODE = 14
+    __slots__ = ()
 
 class Call(UnOp):
     CODE = 0x10
+    __slots__ = ()
 
 class Ret:
     CODE = 0x11
+    __slots__ = ('bytecode',)
+    auto = False
+
+    def __init__(self):
+        self.bytecode = _RET_BC
 
     def make(self, code):
-        self.bytecode = bytes([code])
+        self.bytecode = _RET_BC
+        return _RET_BC
+
     def __str__(self):
         return "ret"
 
+_RET_BC = bytes([Ret.CODE])
+
 class Cmp(BinOp):
     CODE = 0x12
+    __slots__ = ()
 
 class Jmp(UnOp):
     CODE = 0x13
+    __slots__ = ()
 
 class Je(UnOp):
     CODE = 0x14
+    __slots__ = ()
 
 class Jne(UnOp):
     CODE = 0x15
+    __slots__ = ()
     
 class Jg(UnOp):
     CODE = 0x16
+    __slots__ = ()
 
 class Jl(UnOp):
     CODE = 0x18
+    __slots__ = ()
 
 class Jge(UnOp):
     CODE = 0x19
+    __slots__ = ()
     
 class Ja(UnOp):
     CODE = 0x1a
+    __slots__ = ()
     
 class Jnbe(UnOp):
     CODE = 0x1b
+    __slots__ = ()
     
 class Jb(UnOp):
     CODE = 0x1c
+    __slots__ = ()
     
 class Jc(UnOp):
     CODE = 0x1d
-
-inses = []
-bytecodes = []
-labels = []
-
-
+    __slots__ = ()
 
 Q = 64
 D = 32
 S = 16
 B = 8
+AUTO = 0
+
+# upper bound of shrinking rounds, it usually converges in 2 or 3
+AUTO_ITERATIONS = 16
+
+# assembled payloads for assemble(cache=True), keyed by a hash of the
+# program and of this file
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'asm_py')
 
 BINOPS = [
     'mov',
@@ -346,21 +443,32 @@ BINOPS = [
     'shr',
     'cmp',
 ]
-def binop_ins(insname, mod, x, y):
-    global inses
-    class_name = insname.capitalize()
-    inses.append(globals()[class_name](x, y, mod))
-
-for op in BINOPS:
-    def inner(op):
-        globals()[op] = lambda mod, x, y: binop_ins(op, mod, x, y)
-    inner(op)
+_BINOP_CLS = {
+    'mov': Mov,
+    'add': Add,
+    'sub': Sub,
+    'mul': Mul,
+    'div': Div,
+    'mod': Mod,
+    'xor': Xor,
+    'or': Or,
+    'and': And,
+    'shl': Shl,
+    'shr': Shr,
+    'cmp': Cmp,
+}
+
+def _mk_binop(op, cls):
+    def binop(self, mod, x, y):
+        self.inses.append(cls(x, y, mod))
+    binop.__name__ = op
+    binop.__qualname__ = 'Assembler.' + op
+    return binop
 
 
 UOPS = [
     'push',
     'pop',
-    'nop',
     'jmp',
     'call',
     'je',
@@ -374,76 +482,278 @@ UOPS = [
     'jc'
 ]
 
-def uop_ins(insname, mod, x):
-    global inses
-    class_name = insname.capitalize()
-    inses.append(globals()[class_name](x, mod))
-
-for op in UOPS:
-    def inner(op):
-        globals()[op] = lambda mod, x: uop_ins(op, mod, x)
-    inner(op)
+_UOP_CLS = {
+    'push': Push,
+    'pop': Pop,
+    'jmp': Jmp,
+    'call': Call,
+    'je': Je,
+    'jne': Jne,
+    'jg': Jg,
+    'jl': Jl,
+    'jge': Jge,
+    'ja': Ja,
+    'jnbe': Jnbe,
+    'jb': Jb,
+    'jc': Jc,
+}
+
+def _mk_uop(op, cls):
+    def uop(self, mod, x):
+        ins = cls(x, mod)
+        if type(x) is LabelRef:
+            x.label.use(ins, len(self.inses))
+        self.inses.append(ins)
+    uop.__name__ = op
+    uop.__qualname__ = 'Assembler.' + op
+    return uop
 
 NOOPS = [
-    'exit'
-    'ret'
+    'exit',
+    'ret',
 ]
 
-def exit():
-    global inses
-    inses.append(Exit())
-
-def ret():
-    global inses
-    inses.append(Ret())
-
-def tag(label):
-    global inses, labels
-    #inses.append(label.tag(len(inses)))
-    label.tag(len(inses))
-    labels.append(label)
+COND_JUMPS = (Je, Jne, Jg, Jl, Jge, Ja, Jnbe, Jb, Jc)
+
+def flags_live(inses, i, def_sites):
+    # whether the flags after inses[i] may still be read, only cmp is
+    # trusted to overwrite them, labels and control flow are barriers
+    # except a plain jmp to a label, which is followed
+    j = i + 1
+    followed = set()
+    jumped = False
+    while j < len(inses):
+        ins = inses[j]
+        if (j in def_sites and not jumped) or isinstance(ins, COND_JUMPS):
+            return True
+        jumped = False
+        if type(ins) is Cmp or type(ins) is Exit:
+            return False
+        if type(ins) is Jmp and type(ins.dest) is LabelRef:
+            j = ins.dest.label.def_site
+            if j is None or j in followed:
+                return True
+            followed.add(j)
+            jumped = True
+            continue
+        if type(ins) is Jmp or type(ins) is Call or type(ins) is Ret:
+            return True
+        j += 1
+    return False
+
+# small ints for the operand types, so program_key can marshal the program
+_OPERAND_TAG = {
+    type(None): 0,
+    Reg: 1,
+    Imm: 2,
+    Mem: 3,
+    StackMem: 4,
+    LabelRef: 5,
+}
+
+def operand_key(op, label_ids):
+    tag = _OPERAND_TAG[type(op)]
+    if tag == 5:
+        # labels by position, names are not unique
+        try:
+            return tag, label_ids[id(op.label)]
+        except KeyError:
+            raise Exception('label {} is never tagged'.format(op.name))
+    if tag == 3 or tag == 4:
+        return tag, operand_key(op.addr, label_ids)
+    if tag == 1:
+        return tag, op.num
+    if tag == 2:
+        return tag, op.val
+    return tag
+
+def cache_load(key):
+    try:
+        with open(os.path.join(CACHE_DIR, key + '.bin'), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def cache_store(key, bytecode):
+    # write then rename, so a reader never sees a partial payload
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR)
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bytecode)
+        os.replace(tmp, os.path.join(CACHE_DIR, key + '.bin'))
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+class Assembler:
+    """Holds one program under construction, the module level helpers
+    (`mov`, `tag`, `assemble`, ...) are bound to `default_assembler`.
+    For an independent program use `with Assembler() as a: a.mov(B, a.r1, Imm(0))`.
+    """
 
-def ref(label):
-    global inses
-    return label.ref(len(inses))
-
-
-def assemble():
-    global inses, labels
-
-    # phase 1: generate inses without label resolved
-    for ins in inses:
-        ins.make(ins.CODE)
-
-    # phase 2: resolve labels
-    for label in labels:
-        label.resolve()
+    def __init__(self):
+        self.inses = []
+        self.labels = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def exit(self):
+        self.inses.append(Exit())
+
+    def ret(self):
+        self.inses.append(Ret())
+
+    def tag(self, label):
+        label.tag(len(self.inses))
+        self.labels.append(label)
+
+    def ref(self, label):
+        return label.ref()
+
+    def peephole(self, verbose=False):
+        inses = self.inses
+        def_sites = {label.def_site for label in self.labels}
+        for i, ins in enumerate(inses):
+            # both rewrites change the flags, xor sets them where mov didn't
+            # and sub inverts the carry of add
+            # at B width mov and xor take the same 4 bytes
+            if type(ins) is Mov and ins.size > B and type(ins.dest) is Reg and type(ins.src) is Imm and ins.src.val == 0:
+                new = Xor(ins.dest, ins.dest, ins.size)
+            elif type(ins) is Add and type(ins.src) is Imm and ins.src.val < 0:
+                new = Sub(ins.dest, Imm(-ins.src.val), ins.size)
+            else:
+                continue
+            if flags_live(inses, i, def_sites):
+                continue
+            if verbose:
+                print('peephole #{}: {} -> {}'.format(i, ins, new))
+            inses[i] = new
+
+    def program_key(self):
+        # one tuple of plain ints for the whole program, serialized and
+        # hashed once
+        inses, labels = self.inses, self.labels
+        label_ids = {id(label): i for i, label in enumerate(labels)}
+        # registers and small immediates are shared objects, key each once
+        seen = {}
+        keys = []
+        for ins in inses:
+            dest = getattr(ins, 'dest', None)
+            src = getattr(ins, 'src', None)
+            dest_key = seen.get(id(dest))
+            if dest_key is None:
+                dest_key = seen[id(dest)] = operand_key(dest, label_ids)
+            src_key = seen.get(id(src))
+            if src_key is None:
+                src_key = seen[id(src)] = operand_key(src, label_ids)
+            # AUTO jumps are shrunk in place, key them by what was written
+            size = AUTO if ins.auto else getattr(ins, 'size', None)
+            keys.append((ins.CODE, size, dest_key, src_key))
+        program = (
+            os.path.getmtime(__file__),
+            tuple(label.def_site for label in labels),
+            tuple(keys),
+        )
+        return hashlib.blake2b(marshal.dumps(program)).hexdigest()
+
+    def assemble(self, listing=False, cache=False, peephole=False):
+        inses, labels = self.inses, self.labels
+
+        if peephole:
+            self.peephole(listing)
+
+        # the listing needs every instruction encoded, so it skips the cache
+        key = None
+        if cache and not listing:
+            key = self.program_key()
+            bytecode = cache_load(key)
+            if bytecode is not None:
+                return bytecode
+
+        # phase 1: generate inses without label resolved
+        for ins in inses:
+            ins.make(ins.CODE)
 
-    # phase 3: adjust bytecodes
-    for label in labels:
-        label.rewrite()
+        # phase 2: resolve labels, shrinking AUTO sized jumps until fixed point
+        for _ in range(AUTO_ITERATIONS):
+            # byte offset of every instruction, offsets[i] is where inses[i] starts
+            sizes = [len(ins.bytecode) for ins in inses]
+            offsets = list(itertools.accumulate(sizes, initial=0))
+            for label in labels:
+                label.resolve(offsets)
+
+            changed = False
+            for label in labels:
+                changed |= label.shrink(offsets)
+            if not changed:
+                break
+        else:
+            # sizes chosen so far still fit, offsets just need a refresh
+            sizes = [len(ins.bytecode) for ins in inses]
+            offsets = list(itertools.accumulate(sizes, initial=0))
+            for label in labels:
+                label.resolve(offsets)
+
+        # phase 3: lay every instruction out once, label uses hold zero
+        # placeholders that are patched in place
+        out = bytearray().join([ins.bytecode for ins in inses])
+        for label in labels:
+            label.rewrite(offsets, out)
+
+        if listing:
+            for ins, offset in zip(inses, offsets):
+                print(offset, ins)
+
+        bytecode = bytes(out)
+        if key is not None:
+            cache_store(key, bytecode)
+        return bytecode
+
+    def emit(self, path=None, peephole=False):
+        # path None keeps the payload in memory only
+        bytecode = self.assemble(peephole=peephole)
+        if path is not None:
+            with open(path, 'wb') as f:
+                f.write(bytecode)
+        return bytecode
 
-    # phase 4: propagate all bytecode
+for op in BINOPS:
+    setattr(Assembler, op, _mk_binop(op, _BINOP_CLS[op]))
 
-    bytecode = b''
-    for ins in inses:
-        print(len(bytecode), ins)
-        bytecode += ins.bytecode
-    return bytecode
+for op in UOPS:
+    setattr(Assembler, op, _mk_uop(op, _UOP_CLS[op]))
 
 for i in range(0x11 + 1):
     name = 'r{}'.format(i)
     globals()[name] = Reg(name)
+    setattr(Assembler, name, globals()[name])
+
+default_assembler = Assembler()
+inses = default_assembler.inses
+labels = default_assembler.labels
+
+for name in BINOPS + UOPS + NOOPS + ['tag', 'ref', 'peephole', 'program_key', 'assemble', 'emit']:
+    globals()[name] = getattr(default_assembler, name)
 
 
 
-def main_bubble():
+def main_bubble(path='test_asm'):
     loop = Label('loop')
     
 
     big_loop = Label('big_loop')
     loop = Label('loop')
-    skip = Label('skip')
+    swap = Label('swap')
 
     mov(B, r8, Imm(8))
     mov(B, r0, Imm(100))
@@ -457,58 +767,77 @@ def main_bubble():
     mov(Q, r3, Mem(r1))
     mov(Q, r4, Mem(r2))
     cmp(Q, r3, r4)
+    jge(AUTO, ref(swap))
 
-    jl(B, ref(skip))
-    mov(Q, Mem(r1), r4)
-    mov(Q, Mem(r2), r3)
-
-    tag(skip)
     add(Q, r1, r8)
     add(Q, r2, r8)
     cmp(S, r2, Imm(800))
 
-    jl(B, ref(loop)) 
+    jl(AUTO, ref(loop)) 
     sub(Q, r0, r7)
 
-    jg(B, ref(big_loop))
+    jg(AUTO, ref(big_loop))
 
     exit()
 
+    # out of line so the no-swap path falls through, with its own copy
+    # of the loop tail instead of a jump back
+    tag(swap)
+    mov(Q, Mem(r1), r4)
+    mov(Q, Mem(r2), r3)
+    add(Q, r1, r8)
+    add(Q, r2, r8)
+    cmp(S, r2, Imm(800))
+    jl(AUTO, ref(loop))
+    sub(Q, r0, r7)
+    jg(AUTO, ref(big_loop))
+    exit()
+
 
-    with open('test_asm', 'wb') as f:
-        f.write(assemble())
+    return emit(path)
 
-def main_quicksort():
+def main_quicksort(path='payload'):
 
-    # call convention
-    # r0: ret
-    # r1-r2: args
+    # no call/ret, the left part of each partition is sorted next, the
+    # right part waits on the stack as (left, right), left on top, and
+    # r13 counts the waiting ranges
 
-    quicksort = Label("quicksort")
-    end_qsort = Label("end_qsort")
+    dispatch = Label("dispatch")
+    partition = Label("partition")
+    done = Label("done")
     loop_check = Label("loop_check")
     loop_begin = Label("loop_begin")
     loop1_end = Label("loop1_end")
     loop1_begin = Label("loop1_begin")
+    loop1_body = Label("loop1_body")
     loop2_end = Label("loop2_end")
     loop2_begin = Label("loop2_begin")
+    loop2_body = Label("loop2_body")
 
     # quicksort(0, 800-1)
     mov(S, r1, Imm(0))
     mov(S, r2, Imm((100-1)*8))
-    call(B, ref(quicksort))
-    exit()
+    mov(S, r13, Imm(0))
+    jmp(AUTO, ref(partition))
 
-    tag(quicksort)
+    tag(dispatch)
     # r1: left, r2: right
     # r11: low, r12: high
     # r0: pivot
     # r4: array[low]
     # r5: array[high]
+    # r13: pending ranges
 
-    # if left < right: ret
+    cmp(S, r13, Imm(0))
+    je(AUTO, ref(done))
+    pop(S, r1)
+    pop(S, r2)
+    sub(S, r13, Imm(1))
+
+    tag(partition)
+    # if left >= right: next range
     cmp(S, r1, r2)
-    jge(B, ref(end_qsort))
+    jge(AUTO, ref(dispatch))
     # pivot = array[left]
     mov(Q, r0, Mem(r1))
     # low = left
@@ -516,55 +845,55 @@ def main_quicksort():
     # high = right
     mov(S, r12, r2)
 
-    jmp(B, ref(loop_check))
-    tag(loop_begin)
+    jmp(AUTO, ref(loop_check))
 
+    # both inner loops test at the bottom, so the back edge is the taken
+    # branch and leaving the loop falls through
+    tag(loop1_body)
+    sub(S, r12, Imm(8))
+    tag(loop_begin)
     tag(loop1_begin)
     mov(Q, r5, Mem(r12))
     cmp(Q, r5, r0)
-    jl(B, ref(loop1_end))
+    jl(AUTO, ref(loop1_end))
     cmp(S, r11, r12)
-    jge(B, ref(loop1_end))
-    sub(S, r12, Imm(8))
-    jmp(B, ref(loop1_begin))
+    jl(AUTO, ref(loop1_body))
     tag(loop1_end)
     mov(Q, Mem(r11), r5)
+    jmp(AUTO, ref(loop2_begin))
 
+    tag(loop2_body)
+    add(S, r11, Imm(8))
     tag(loop2_begin)
     mov(Q, r4, Mem(r11))
     cmp(Q, r4, r0)
-    jg(B, ref(loop2_end))
+    jg(AUTO, ref(loop2_end))
     cmp(S, r11, r12)
-    jge(B, ref(loop2_end))
-    add(S, r11, Imm(8))
-    jmp(B, ref(loop2_begin))
+    jl(AUTO, ref(loop2_body))
     tag(loop2_end)
     mov(Q, Mem(r12), r4)
 
     tag(loop_check)
     cmp(S, r11, r12)
-    jl(B, ref(loop_begin))
+    jl(AUTO, ref(loop_begin))
 
     # array[low] = pivot
     mov(Q, Mem(r11), r0)
-    # qsort(left, low-1)
+    # qsort(low+1, right)
     push(S, r2)
+    add(S, r11, Imm(8))
     push(S, r11)
+    add(S, r13, Imm(1))
+    # qsort(left, low-1) right away, left stays in r1
     mov(S, r2, r11)
-    sub(S, r2, Imm(8))
-    call(B, ref(quicksort))
-    # qsort(low+1, right)
-    pop(S, r1)
-    add(S, r1, Imm(8))
-    pop(S, r2)
-    call(B, ref(quicksort))
+    sub(S, r2, Imm(16))
+    jmp(AUTO, ref(partition))
 
-    tag(end_qsort)
-    ret()
+    tag(done)
+    exit()
 
 
-    with open("payload", "wb") as f:
-        f.write(assemble())
+    return emit(path, peephole=True)
 
 
 if __name__ == "__main__":
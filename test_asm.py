@@ -0,0 +1,286 @@
+"""Runs assembled payloads on a small model of the challenge VM.
+
+The model decodes the emitted bytes, so it checks the encoder and the label
+patching as well as the programs. Flags: cmp keeps both operands, add/sub
+keep the result compared against 0; conditional jumps are signed. Only what
+the shipped programs use is modeled.
+
+   python -m unittest test_asm
+"""
+
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import asm
+
+_SIZE = {0x10: 8, 0x20: 16, 0x30: 32, 0x40: 64}
+
+_JUMPS = {
+    asm.Jmp.CODE: lambda a, b: True,
+    asm.Je.CODE: lambda a, b: a == b,
+    asm.Jne.CODE: lambda a, b: a != b,
+    asm.Jg.CODE: lambda a, b: a > b,
+    asm.Jl.CODE: lambda a, b: a < b,
+    asm.Jge.CODE: lambda a, b: a >= b,
+}
+
+_ALU = {
+    asm.Add.CODE: lambda a, b: a + b,
+    asm.Sub.CODE: lambda a, b: a - b,
+    asm.Xor.CODE: lambda a, b: a ^ b,
+}
+
+
+def signed(x, size):
+    x &= (1 << size) - 1
+    return x - (1 << size) if x >> (size - 1) else x
+
+
+class VM:
+    def __init__(self, code, data):
+        self.code = code
+        self.mem = {i * 8: v & asm._MASK[64] for i, v in enumerate(data)}
+        self.regs = [0] * (0x11 + 1)
+        self.stack = []
+        self.flags = (0, 0)
+        self.pc = 0
+        self.steps = 0
+
+    def fetch(self, n):
+        val = int.from_bytes(self.code[self.pc:self.pc + n], 'little')
+        self.pc += n
+        return val
+
+    def operands(self, mode, size):
+        # (kind, value) of dest and src, kind is 'reg', 'imm' or 'mem'
+        reg = lambda: ('reg', self.fetch(1))
+        imm = lambda: ('imm', self.fetch(size // 8))
+        mem_imm = lambda: ('mem', self.fetch(size // 8))
+        mem_reg = lambda: ('mem', self.regs[self.fetch(1)])
+        layout = {
+            0: (reg, reg),
+            1: (reg, mem_imm),
+            2: (mem_imm, reg),
+            5: (reg, imm),
+            6: (reg,),
+            7: (imm,),
+            0xb: (mem_reg, reg),
+            0xc: (reg, mem_reg),
+        }[mode]
+        return [operand() for operand in layout]
+
+    def read(self, op, size):
+        kind, val = op
+        if kind == 'reg':
+            val = self.regs[val]
+        elif kind == 'mem':
+            val = self.mem[val]
+        return val & asm._MASK[size]
+
+    def write(self, op, size, val):
+        kind, where = op
+        if kind == 'reg':
+            self.regs[where] = val & asm._MASK[size]
+        else:
+            self.mem[where] = val & asm._MASK[size]
+
+    def run(self, limit=10 ** 7):
+        while self.steps < limit:
+            self.steps += 1
+            code = self.fetch(1)
+            if code == asm.Exit.CODE:
+                return
+            if code == asm.Ret.CODE:
+                self.pc = self.stack.pop()
+                continue
+            mode = self.fetch(1)
+            size = _SIZE[mode & 0xf0]
+            ops = self.operands(mode & 0x0f, size)
+            if code in _JUMPS or code == asm.Call.CODE:
+                dis = signed(ops[0][1], size)
+                if code == asm.Call.CODE:
+                    self.stack.append(self.pc)
+                    self.pc += dis
+                elif _JUMPS[code](*self.flags):
+                    self.pc += dis
+            elif code == asm.Push.CODE:
+                self.stack.append(self.read(ops[0], size))
+            elif code == asm.Pop.CODE:
+                self.write(ops[0], size, self.stack.pop())
+            elif code == asm.Mov.CODE:
+                self.write(ops[0], size, self.read(ops[1], size))
+            elif code == asm.Cmp.CODE:
+                self.flags = (signed(self.read(ops[0], size), size),
+                              signed(self.read(ops[1], size), size))
+            elif code in _ALU:
+                val = _ALU[code](self.read(ops[0], size), self.read(ops[1], size))
+                self.write(ops[0], size, val)
+                self.flags = (signed(val, size), 0)
+            else:
+                raise Exception('opcode {} is not modeled'.format(code))
+        raise Exception('no exit after {} steps'.format(limit))
+
+
+def payload(main):
+    # the sort programs build into the module wide default program
+    del asm.inses[:]
+    del asm.labels[:]
+    return main(None)
+
+
+def program(main):
+    # the instructions of a sort program, not assembled yet
+    del asm.inses[:]
+    del asm.labels[:]
+    with mock.patch.object(asm, 'emit', lambda path, **kw: None):
+        main(None)
+    return asm.default_assembler
+
+
+def sorts(code):
+    rnd = random.Random(0)
+    cases = [
+        [rnd.randrange(-1000, 1000) for _ in range(100)],
+        [rnd.randrange(-2 ** 63, 2 ** 63) for _ in range(100)],
+        [rnd.randrange(4) for _ in range(100)],
+        list(range(100)),
+        list(range(100, 0, -1)),
+        [7] * 100,
+    ]
+    for data in cases:
+        vm = VM(code, data)
+        vm.run()
+        if [signed(vm.mem[i * 8], 64) for i in range(100)] != sorted(data):
+            return False
+    return True
+
+
+class SortTest(unittest.TestCase):
+    def test_quicksort(self):
+        self.assertTrue(sorts(payload(asm.main_quicksort)))
+
+    def test_bubble(self):
+        self.assertTrue(sorts(payload(asm.main_bubble)))
+
+
+class AutoJumpTest(unittest.TestCase):
+    def padded_loop(self, skip, body):
+        # a forward jmp over skip movs into a loop of body movs, run 3 times
+        with asm.Assembler() as a:
+            top = asm.Label('top')
+            a.mov(asm.Q, a.r0, asm.Imm(3))
+            a.jmp(asm.AUTO, a.ref(top))
+            for i in range(skip):
+                a.mov(asm.Q, a.r6, asm.Imm(i))
+            a.tag(top)
+            for i in range(body):
+                a.mov(asm.Q, a.r1, asm.Imm(i))
+            a.add(asm.Q, a.r5, asm.Imm(1))
+            a.sub(asm.Q, a.r0, asm.Imm(1))
+            a.jg(asm.AUTO, a.ref(top))
+            a.exit()
+            vm = VM(a.assemble(), [])
+        vm.run()
+        self.assertEqual(vm.regs[5], 3)
+        self.assertEqual(vm.regs[6], 0)
+        return [ins.size for ins in a.inses if type(ins) in (asm.Jmp, asm.Jg)]
+
+    def test_16(self):
+        self.assertEqual(self.padded_loop(0, 20), [asm.B, asm.S])
+
+    def test_32(self):
+        self.assertEqual(self.padded_loop(3000, 3000), [asm.D, asm.D])
+
+
+class PeepholeTest(unittest.TestCase):
+    def test_keeps_live_flags(self):
+        with asm.Assembler() as a:
+            taken = asm.Label('taken')
+            a.mov(asm.Q, a.r1, asm.Imm(3))
+            a.cmp(asm.Q, a.r1, asm.Imm(5))
+            a.mov(asm.Q, a.r2, asm.Imm(0))
+            a.mov(asm.Q, a.r3, a.r1)
+            a.jl(asm.AUTO, a.ref(taken))
+            a.mov(asm.Q, a.r4, asm.Imm(1))
+            a.exit()
+            a.tag(taken)
+            a.mov(asm.Q, a.r4, asm.Imm(2))
+            a.exit()
+            vm = VM(a.assemble(peephole=True), [])
+        vm.run()
+        self.assertEqual(vm.regs[4], 2)
+        self.assertIs(type(a.inses[2]), asm.Mov)
+
+    def test_rewrites_dead_flags(self):
+        with asm.Assembler() as a:
+            a.mov(asm.Q, a.r1, asm.Imm(0))
+            a.mov(asm.B, a.r2, asm.Imm(0))
+            a.add(asm.Q, a.r3, asm.Imm(-8))
+            a.exit()
+            a.assemble(peephole=True)
+        self.assertIs(type(a.inses[0]), asm.Xor)
+        # no shorter at B width
+        self.assertIs(type(a.inses[1]), asm.Mov)
+        self.assertIs(type(a.inses[2]), asm.Sub)
+        self.assertEqual(a.inses[2].src.val, 8)
+
+    def test_quicksort_startup(self):
+        # the zeroing movs are followed through the jmp into partition,
+        # which starts with cmp
+        a = program(asm.main_quicksort)
+        plain = a.assemble()
+        code = a.assemble(peephole=True)
+        self.assertIs(type(a.inses[0]), asm.Xor)
+        self.assertIs(type(a.inses[2]), asm.Xor)
+        self.assertEqual(len(code), len(plain) - 2)
+        self.assertTrue(sorts(code))
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = mock.patch.object(asm, 'CACHE_DIR', tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def build(self, imm=1, site=1):
+        # a loop, with one operand and where its label sits as parameters
+        a = asm.Assembler()
+        loop = asm.Label('loop')
+        a.mov(asm.Q, a.r1, asm.Imm(3))
+        if site == 0:
+            a.tag(loop)
+        a.mov(asm.Q, a.r2, asm.Imm(imm))
+        if site == 1:
+            a.tag(loop)
+        a.sub(asm.Q, a.r1, a.r2)
+        a.jg(asm.AUTO, a.ref(loop))
+        a.exit()
+        return a
+
+    def test_hit(self):
+        code = self.build().assemble(cache=True)
+        self.assertEqual(len(os.listdir(asm.CACHE_DIR)), 1)
+        # a hit returns before anything is encoded
+        with mock.patch.object(asm.Mov, 'make') as make:
+            self.assertEqual(self.build().assemble(cache=True), code)
+        make.assert_not_called()
+
+    def test_keys(self):
+        key = self.build().program_key()
+        self.assertEqual(self.build().program_key(), key)
+        self.assertNotEqual(self.build(imm=2).program_key(), key)
+        self.assertNotEqual(self.build(site=0).program_key(), key)
+
+    def test_failed_store(self):
+        with mock.patch.object(os, 'replace', side_effect=OSError):
+            self.build().assemble(cache=True)
+        self.assertEqual(os.listdir(asm.CACHE_DIR), [])
+
+
+if __name__ == '__main__':
+    unittest.main()